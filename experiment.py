@@ -10,11 +10,19 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 
+import pyarrow as pa
+import pyarrow.parquet as pq
+
 import experiment_data_collection
+import experiment_io
 import constants as consts
 
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
+from sklearn.metrics.pairwise import euclidean_distances
+
+# number of rows processed at a time by PCA
+PCA_BLOCK_SIZE = 100000
 
 
 def __get_dfs_for_boxplot(dataframe, cluster_number):
@@ -69,62 +77,254 @@ def create_experiment():
     os.makedirs(os.path.dirname(path + "/"), exist_ok=True)
     return path
 
-def save_configuration():
-    _dict = {
-        "EXPERIMENT_NAME": EXPERIMENT_NAME,
+# parameters that determine the artifacts of an experiment (dataframe, PCA and k-means models)
+def __artifacts_parameters():
+    return {
         "EXPERIMENT_TYPE": EXPERIMENT_TYPE,
         "SESSION_LENGTH": SESSION_LENGTH,
         "CONTEXT_TYPES": CONTEXT_TYPES,
-        "PCA_COMPONENTS": PCA_COMPONENTS
+        "PCA_COMPONENTS": PCA_COMPONENTS,
+        "SAMPLE_FRAC": SAMPLE_FRAC,
+        "SAMPLE_N": SAMPLE_N,
+        "SEED": SEED
     }
-    with open("{0}/conf.json".format(EXPERIMENT_NAME), "w") as fp:
-        json.dump(_dict, fp)
+
+def __kmeans_model_path(path):
+    return "{0}/kmeans_models/kmeans_{1}.pkl".format(path, consts.N_CLUSTER_STR)
+
+# artifacts of an existing experiment are reused only if they were generated with the same parameters. It returns the
+# saved configuration of the experiment if its artifacts can be reused, an empty one if there are no artifacts
+def check_configuration():
+    conf_path = "{0}/conf.json".format(EXPERIMENT_NAME)
+    artifacts = ["{0}/dataframe.parquet".format(EXPERIMENT_NAME), "{0}/pca.pkl".format(EXPERIMENT_NAME), __kmeans_model_path(EXPERIMENT_NAME)]
+
+    if not any(os.path.isfile(x) for x in artifacts):
+        return {}
+    if not os.path.isfile(conf_path):
+        raise Exception("Experiment '{0}' has artifacts but no conf.json. Delete the experiment folder to regenerate it".format(EXPERIMENT_NAME))
+
+    with open(conf_path, "r") as fp:
+        saved = json.load(fp)
+
+    # experiments created before sampling was introduced have no sampling parameters in their configuration, and
+    # the seed is only relevant if sessions are sampled
+    current = __artifacts_parameters()
+    saved_parameters = {x: saved.get(x) for x in current}
+    if (saved_parameters["SAMPLE_FRAC"] is None) and (saved_parameters["SAMPLE_N"] is None):
+        saved_parameters["SEED"] = None
+    elif "SEED" not in saved:
+        saved_parameters["SEED"] = 0
+    different = [x for x in current if saved_parameters[x] != current[x]]
+    if different:
+        raise Exception("Experiment '{0}' already exists with different {1}. Use a different --name, or delete the experiment folder to regenerate it".format(
+            EXPERIMENT_NAME, ", ".join("{0} ({1} instead of {2})".format(x, saved_parameters[x], current[x]) for x in different)))
+
+    return saved
+
+# `previous` is the configuration of the reused artifacts (if any): values recorded for them (e.g. sample size) are kept
+def save_configuration(previous):
+    _dict = dict(previous)
+    _dict["EXPERIMENT_NAME"] = EXPERIMENT_NAME
+    _dict.update(__artifacts_parameters())
+    experiment_io.atomic_json_dump(_dict, "{0}/conf.json".format(EXPERIMENT_NAME))
+
+def load_configuration():
+    with open("{0}/conf.json".format(EXPERIMENT_NAME), "r") as fp:
+        return json.load(fp)
+
+# add values only known once the run has progressed (e.g. actual sample size) to the saved configuration
+def update_configuration(values):
+    _dict = load_configuration()
+    _dict.update(values)
+    experiment_io.atomic_json_dump(_dict, "{0}/conf.json".format(EXPERIMENT_NAME))
 
 def collect_dataframe():
     dataframe_path = "{0}/dataframe.parquet".format(EXPERIMENT_NAME)
 
-    # if it already exists, load it in memory. Otherwise, generate it (it is also automatically saved)
-    if os.path.isfile(dataframe_path):
-        dataframe = pd.read_parquet(dataframe_path)
-    else:
-        dataframe = experiment_data_collection.generate_dataframe(EXPERIMENT_TYPE, SESSION_LENGTH, CONTEXT_TYPES, dataframe_path)
+    # an experiment keeps using the shared matrix it was generated from (shared matrices are never modified), so that
+    # its dataframe and models stay consistent even if day databases change afterwards
+    shared_path = load_configuration().get("SHARED_MATRIX")
+    if (shared_path is None) or (not os.path.isfile(shared_path)):
+        # a dataframe not generated through a shared matrix (e.g. from before they were introduced) cannot be matched
+        # to the current day databases, so it is only used by this experiment
+        if os.path.isfile(dataframe_path):
+            return pd.read_parquet(dataframe_path)
+
+        days = experiment_data_collection.get_days(EXPERIMENT_TYPE)
+        shared_path = experiment_io.shared_matrix_path(EXPERIMENT_TYPE, SESSION_LENGTH, CONTEXT_TYPES, SAMPLE_FRAC, SAMPLE_N, SEED, days)
+        os.makedirs(os.path.dirname(shared_path), exist_ok=True)
+
+        # the shared matrix is generated once, by the first run that needs it. Concurrent runs on the same conditions
+        # wait for it instead of generating their own copy (the dataframe is also automatically saved)
+        with experiment_io.file_lock(shared_path + ".lock"):
+            if not os.path.isfile(shared_path):
+                dataframe, population = experiment_data_collection.generate_dataframe(EXPERIMENT_TYPE, SESSION_LENGTH, CONTEXT_TYPES, dataframe_path,
+                    sample_frac=SAMPLE_FRAC, sample_n=SAMPLE_N, seed=SEED)
+                experiment_io.save_shared_matrix(dataframe, shared_path, {"POPULATION_SIZE": population})
+                del dataframe
+
+            # recorded while holding the lock, so that the matrix is never pruned before the experiment refers to it
+            update_configuration({"SHARED_MATRIX": shared_path})
+
+    population = experiment_io.load_shared_matrix_info(shared_path)["POPULATION_SIZE"]
+    if population is not None:
+        update_configuration({"POPULATION_SIZE": population})
+
+    # memory-mapped (read-only) view of the shared matrix
+    dataframe = experiment_io.load_shared_matrix(shared_path)
+
+    # the experiment's own dataframe is still needed by `analysis.py`
+    if not os.path.isfile(dataframe_path):
+        experiment_io.atomic_to_parquet(dataframe, dataframe_path)
 
     return dataframe
 
+# boundaries of blocks of (at least) PCA_BLOCK_SIZE rows, covering `n_rows` rows
+def __row_blocks(n_rows):
+    n_blocks = max(1, n_rows // PCA_BLOCK_SIZE)
+    bounds = [n_rows * i // n_blocks for i in range(n_blocks + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# exact PCA (as `PCA.fit`), computed from the covariance matrix. Number of rows, column sums and XᵀX are accumulated
+# one block of rows at a time, so that no full (centred) copy of the dataframe is made. Sessions have only
+# SESSION_LENGTH columns, so the eigendecomposition of the covariance matrix is cheap
+def __fit_pca(dataframe, blocks):
+    n_features = dataframe.shape[1]
+    n_samples = 0
+    sums = np.zeros(n_features)
+    products = np.zeros((n_features, n_features))
+    for start, end in blocks:
+        block = dataframe.iloc[start:end].to_numpy(dtype=np.float64)
+        n_samples += block.shape[0]
+        sums += block.sum(axis=0)
+        products += block.T @ block
+
+    mean = sums / n_samples
+    covariance = (products - n_samples * np.outer(mean, mean)) / (n_samples - 1)
+
+    # eigenvalues in descending order. Signs of components are fixed as `PCA` does with `svd_flip` on components
+    # (largest absolute loading is positive), which doesn't change distances and therefore k-means clusters
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues = np.clip(eigenvalues[order], 0, None)
+    components = eigenvectors[:, order].T
+    signs = np.sign(components[np.arange(n_features), np.argmax(np.abs(components), axis=1)])
+    components *= signs[:, np.newaxis]
+
+    # fitted attributes of `PCA`, so that the model is used (transform, inverse_transform) and saved as any other
+    pca = PCA(n_components=PCA_COMPONENTS)
+    pca.n_samples_, pca.n_features_, pca.n_features_in_ = n_samples, n_features, n_features
+    pca.n_components_ = PCA_COMPONENTS
+    pca.mean_ = mean
+    pca.components_ = components[:PCA_COMPONENTS]
+    pca.explained_variance_ = eigenvalues[:PCA_COMPONENTS]
+    pca.explained_variance_ratio_ = pca.explained_variance_ / eigenvalues.sum()
+    pca.singular_values_ = np.sqrt(pca.explained_variance_ * (n_samples - 1))
+    pca.noise_variance_ = eigenvalues[PCA_COMPONENTS:].mean() if PCA_COMPONENTS < n_features else 0.0
+
+    return pca
+
+# PCA is fitted and applied one block of rows at a time, so that no full copy of the (shared) dataframe is made
 def pca_run(dataframe):
     pca_model_path = "{0}/pca.pkl".format(EXPERIMENT_NAME)
+    blocks = __row_blocks(dataframe.shape[0])
 
     # if PCA file already exists, load it. Otherwise, apply PCA on dataframe and then save it
     if os.path.isfile(pca_model_path):
         pca = pickle.load(open(pca_model_path, "rb"))
-        pca_vals = pca.transform(dataframe)
     else:
-        # apply PCA on input dataframe
-        pca = PCA(n_components=PCA_COMPONENTS)
-        pca.fit(dataframe)
-        pca_vals = pca.transform(dataframe)
-        pickle.dump(pca, open(pca_model_path,"wb"))
+        pca = __fit_pca(dataframe, blocks)
+        experiment_io.atomic_pickle_dump(pca, pca_model_path)
+
+    pca_vals = np.empty((dataframe.shape[0], pca.n_components_))
+    for start, end in blocks:
+        pca_vals[start:end] = pca.transform(dataframe.iloc[start:end].to_numpy())
 
     return pca_vals
 
 def kmeans_clustering(pca_vals):
     kmeans_models_path = "{0}/kmeans_models".format(EXPERIMENT_NAME)
+    filename = __kmeans_model_path(EXPERIMENT_NAME)
 
-    # if kmeans sub-folder exists, load the model. Otherwise, generate and also save it
-    if os.path.isdir(kmeans_models_path):
-        model = pickle.load(open("{0}/kmeans_{1}.pkl".format(kmeans_models_path, consts.N_CLUSTER_STR), "rb"))
+    # if kmeans model exists, load it. Otherwise, generate and also save it
+    if os.path.isfile(filename):
+        model = pickle.load(open(filename, "rb"))
     else:
-        os.makedirs(os.path.dirname(kmeans_models_path + "/"))
+        os.makedirs(os.path.dirname(kmeans_models_path + "/"), exist_ok=True)
 
         print("Performing kmeans on {0} clusters".format(consts.N_CLUSTERS_INT))
         model = KMeans(n_clusters=consts.N_CLUSTERS_INT, init="k-means++", random_state=0)
         model.fit(pca_vals)
 
-        filename = "{0}/kmeans_{1}.pkl".format(kmeans_models_path, consts.N_CLUSTER_STR)
-        pickle.dump(model, open(filename, "wb"))
+        experiment_io.atomic_pickle_dump(model, filename)
 
     return model
 
+# label every session of the full population with the model fitted on the sample, reading one day at a time. Labels
+# are written day by day, next to their session_id, so that sessions are never all kept in memory. It returns the
+# number of labelled sessions
+def label_population():
+    population_labels_path = "{0}/population_labels.parquet".format(EXPERIMENT_NAME)
+
+    pca = pickle.load(open("{0}/pca.pkl".format(EXPERIMENT_NAME), "rb"))
+    model = pickle.load(open(__kmeans_model_path(EXPERIMENT_NAME), "rb"))
+
+    schema = pa.schema([("session_id", pa.string()), ("day", pa.string()), ("Cluster Number", pa.int8())])
+    n_sessions = 0
+    with experiment_io.atomic_path(population_labels_path) as tmp_path:
+        writer = pq.ParquetWriter(tmp_path, schema)
+        try:
+            for day, df in experiment_data_collection.iterate_daily_dataframes(EXPERIMENT_TYPE, SESSION_LENGTH, CONTEXT_TYPES):
+                if df.shape[0] == 0:
+                    continue
+                day_labels = pd.DataFrame({
+                    "session_id": df.index.values,
+                    "day": os.path.splitext(os.path.basename(day))[0],
+                    "Cluster Number": model.predict(pca.transform(df.to_numpy())).astype("int8")
+                })
+                writer.write_table(pa.Table.from_pandas(day_labels, schema=schema, preserve_index=False))
+                n_sessions += day_labels.shape[0]
+        finally:
+            writer.close()
+
+    return n_sessions
+
+# a drift reference has to be a completed full (not sampled) experiment, on the same conditions
+def check_drift_reference(reference_name):
+    reference_path = "results/{0}".format(reference_name)
+    conf_path = "{0}/conf.json".format(reference_path)
+
+    required = [conf_path, "{0}/pca.pkl".format(reference_path), __kmeans_model_path(reference_path)]
+    missing = [x for x in required if not os.path.isfile(x)]
+    if missing:
+        raise Exception("Drift reference '{0}' is not a completed experiment (missing: {1})".format(reference_name, ", ".join(missing)))
+
+    with open(conf_path, "r") as fp:
+        reference_conf = json.load(fp)
+
+    if (reference_conf.get("SAMPLE_FRAC") is not None) or (reference_conf.get("SAMPLE_N") is not None):
+        raise Exception("Drift reference '{0}' is a sampled experiment, while it has to be a full run".format(reference_name))
+
+    current = {"EXPERIMENT_TYPE": EXPERIMENT_TYPE, "SESSION_LENGTH": SESSION_LENGTH, "CONTEXT_TYPES": CONTEXT_TYPES}
+    for x in current:
+        if reference_conf[x] != current[x]:
+            raise Exception("Drift reference '{0}' has {1} {2} instead of {3}".format(reference_name, x, reference_conf[x], current[x]))
+
+# distance of each cluster centroid of this (sampled) run to the closest centroid of a reference (full) run. Centroids
+# are compared in the original session space, since the two runs have independently fitted PCA models
+def centroid_drift(reference_name):
+    reference_path = "results/{0}".format(reference_name)
+
+    centroids = []
+    for path in [EXPERIMENT_NAME, reference_path]:
+        pca = pickle.load(open("{0}/pca.pkl".format(path), "rb"))
+        model = pickle.load(open(__kmeans_model_path(path), "rb"))
+        centroids.append(pca.inverse_transform(model.cluster_centers_))
+
+    dis = euclidean_distances(centroids[0], centroids[1])
+
+    return dis.min(axis=1).tolist()
+
 def generate_plots(dataframe, model, base_figures_path):
     # add cluster labels
     dataframe["Cluster Number"] = model.labels_
@@ -135,13 +335,20 @@ def generate_plots(dataframe, model, base_figures_path):
 
     __generate_session_types_boxplots(dataframe, _path)
 
-def main(experiment_name, experiment_type, session_length, pca_components, context_types):
-    global EXPERIMENT_NAME, EXPERIMENT_TYPE, SESSION_LENGTH, PCA_COMPONENTS, CONTEXT_TYPES
+def main(experiment_name, experiment_type, session_length, pca_components, context_types,
+        sample_frac=None, sample_n=None, seed=0, full_labels=False, drift_reference=None):
+    global EXPERIMENT_NAME, EXPERIMENT_TYPE, SESSION_LENGTH, PCA_COMPONENTS, CONTEXT_TYPES, SAMPLE_FRAC, SAMPLE_N, SEED
     EXPERIMENT_NAME = experiment_name
     EXPERIMENT_TYPE = experiment_type
     SESSION_LENGTH = session_length
     PCA_COMPONENTS = pca_components
     CONTEXT_TYPES = context_types
+    SAMPLE_FRAC = sample_frac
+    SAMPLE_N = sample_n
+    sampled = (SAMPLE_FRAC is not None) or (SAMPLE_N is not None)
+
+    # the seed has no effect without sampling, so it doesn't distinguish experiments (nor shared matrices)
+    SEED = seed if sampled else None
 
     print("------------------------------------------------------")
     print("Experiment name: {0}".format(EXPERIMENT_NAME))
@@ -153,27 +360,51 @@ def main(experiment_name, experiment_type, session_length, pca_components, conte
     print("SESSION_LENGTH: {0}".format(SESSION_LENGTH))
     print("CONTEXT_TYPES: {0}".format(CONTEXT_TYPES))
     print("PCA_COMPONENTS: {0}".format(PCA_COMPONENTS))
+    if sampled:
+        print("SAMPLE_FRAC: {0}".format(SAMPLE_FRAC))
+        print("SAMPLE_N: {0}".format(SAMPLE_N))
+        print("SEED: {0}".format(SEED))
     print("------------------------------------------------------")
 
-    print("Saving configuration")
-    save_configuration()
+    if drift_reference is not None:
+        check_drift_reference(drift_reference)
+
+    # only one run at a time can write the artifacts of an experiment. A concurrent run of the same experiment waits,
+    # and then reuses the artifacts already generated
+    with experiment_io.file_lock("{0}/.lock".format(EXPERIMENT_NAME)):
+        print("Saving configuration")
+        save_configuration(check_configuration())
 
-    print("Collecting data")
-    df = collect_dataframe()
-    print("... number of records:{0}".format(df.shape[0]))
+        print("Collecting data")
+        df = collect_dataframe()
+        print("... number of records:{0}".format(df.shape[0]))
+        if sampled:
+            update_configuration({"SAMPLE_SIZE": df.shape[0]})
 
-    # create `figures` folder if it doesn't exist
-    figures_path = EXPERIMENT_NAME + "/figures"
-    os.makedirs(os.path.dirname(figures_path + "/"), exist_ok=True)
+        # create `figures` folder if it doesn't exist
+        figures_path = EXPERIMENT_NAME + "/figures"
+        os.makedirs(os.path.dirname(figures_path + "/"), exist_ok=True)
 
-    print("Transforming data with PCA")
-    scores_pca = pca_run(df)
+        print("Transforming data with PCA")
+        scores_pca = pca_run(df)
 
-    print("Generating k-means models")
-    model = kmeans_clustering(scores_pca)
+        print("Generating k-means models")
+        model = kmeans_clustering(scores_pca)
 
-    print("Generating figures")
-    generate_plots(df, model, figures_path)
+        print("Generating figures")
+        generate_plots(df, model, figures_path)
+
+        if full_labels:
+            print("Labelling full population")
+            n_sessions = label_population()
+            print("... number of records:{0}".format(n_sessions))
+            update_configuration({"POPULATION_SIZE": n_sessions})
+
+        if drift_reference is not None:
+            print("Computing centroid drift against: {0}".format(drift_reference))
+            drift = centroid_drift(drift_reference)
+            print("... drift per cluster: {0}".format(drift))
+            update_configuration({"CENTROID_DRIFT_REFERENCE": drift_reference, "CENTROID_DRIFT": drift})
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -191,11 +422,34 @@ if __name__ == "__main__":
     # number of PCA Componenets
     parser.add_argument("--pca", help="Number of PCA Components (default 7)", default=7, type=int)
 
+    # sampling of sessions, stratified by day (and by hour for time-of-day types). Either a fraction or a number of sessions
+    sample_group = parser.add_mutually_exclusive_group()
+    sample_group.add_argument("--sample-frac", help="Fraction of sessions to sample (0-1)", default=None, type=float)
+    sample_group.add_argument("--sample-n", help="Exact number of sessions to sample (or all, if fewer)", default=None, type=int)
+
+    # seed for reproducible sampling
+    parser.add_argument("--seed", help="Seed of the sampling (default 0)", default=0, type=int)
+
+    # label the full population with the model fitted on the sample
+    parser.add_argument("--full-labels", help="Label all sessions with the fitted model (streaming, day by day)", action="store_true")
+
+    # name of a full (non-sampled) experiment to measure centroid drift against
+    parser.add_argument("--drift-reference", help="Name of a full experiment to compute centroid drift against", default=None)
+
     # setting constants
     args = parser.parse_args()
 
+    if (args.sample_frac is not None) and not (0 < args.sample_frac <= 1):
+        parser.error("--sample-frac has to be in (0, 1]")
+    if (args.sample_n is not None) and (args.sample_n <= 0):
+        parser.error("--sample-n has to be positive")
+    if args.seed < 0:
+        parser.error("--seed has to be non-negative")
+
     # there are 6 types of context: editorial_playlist, user_collection, catalog, radio, charts, personalized_playlist.
     # update `context_types` with wanted types (if 2+, a sorted array to avoid ordering issues), empty array otherwise
     context_types = []
 
-    main(args.name, args.type, args.l, args.pca, context_types)
+    main(args.name, args.type, args.l, args.pca, context_types,
+        sample_frac=args.sample_frac, sample_n=args.sample_n, seed=args.seed,
+        full_labels=args.full_labels, drift_reference=args.drift_reference)
@@ -1,8 +1,12 @@
 import os
 import glob
+import zlib
+import numpy as np
 import pandas as pd
 
-from sqlalchemy import create_engine
+import experiment_io
+
+from sqlalchemy import create_engine, text
 
 # select time window
 # "night": 0-5
@@ -24,6 +28,11 @@ def __hour_range(day_time):
     else:
         raise Exception("Unrecognised day_time value. It has to be 'night', 'morning', 'afternoon', 'evening', 'all'")
 
+# day databases are opened read-only, so that many experiments can safely share them at the same time
+def __connect_read_only(day):
+    db_name = "sqlite:///file:{0}?mode=ro&uri=true".format(day)
+    return create_engine(db_name, echo=False)
+
 def __get_all_files():
     return sorted(glob.glob("data/*.db"))
 
@@ -49,12 +58,14 @@ def __get_weekdays_weekends_files():
     
     return weekdays, weekends
 
-def __create_select_query(context_types):
+def __create_select_query(context_types, with_session_ids=False):
+    select = "SELECT session_id, " if with_session_ids else "SELECT "
+
     if context_types:
-        return "SELECT GROUP_CONCAT(DISTINCT context_type) AS context_types, GROUP_CONCAT(listening_pattern) AS listening_pattern"
+        return select + "GROUP_CONCAT(DISTINCT context_type) AS context_types, GROUP_CONCAT(listening_pattern) AS listening_pattern"
 
     # if none of the above, return standard query
-    return "SELECT GROUP_CONCAT(listening_pattern) AS listening_pattern"
+    return select + "GROUP_CONCAT(listening_pattern) AS listening_pattern"
 
 # splitting and filtering of context_types (e.g. only select sessions that
 # have a listening context type equal to catalog). It allows for selection of multiple context types
@@ -83,16 +94,16 @@ def __split_listening_pattern_in_dataframe(dataframe):
 
     return dataframe
 
-def __gather_daily_dataframe(day, session_length, context_types, day_time="all"):
+# if `with_session_ids` is True, the returned dataframe is indexed by session_id
+def __gather_daily_dataframe(day, session_length, context_types, day_time="all", with_session_ids=False):
     # get range of hours
     hour_start, hour_end = __hour_range(day_time)
 
     # connect to db
-    db_name = "sqlite:///{0}".format(day)
-    db = create_engine(db_name, echo=False)
+    db = __connect_read_only(day)
 
     # run sql query and store result to dataframe
-    select_statement = __create_select_query(context_types)
+    select_statement = __create_select_query(context_types, with_session_ids)
     dataframe = pd.read_sql(
         """
         {0}
@@ -111,6 +122,9 @@ def __gather_daily_dataframe(day, session_length, context_types, day_time="all")
     # close connection
     db.dispose()
 
+    if with_session_ids:
+        dataframe = dataframe.set_index("session_id")
+
     if context_types:
         dataframe = __process_context_types_filtering(dataframe, context_types)
 
@@ -119,15 +133,174 @@ def __gather_daily_dataframe(day, session_length, context_types, day_time="all")
 
     return dataframe
 
+# time-of-day conditions are stratified by hour as well as by day
+def __stratified_by_hour(day_time):
+    return day_time in ("night", "morning", "afternoon", "evening")
+
+# sub-query returning the sessions (one row per session, ordered by session_id) satisfying the experimental conditions
+# of a day, without their listening patterns. Context types filtering is done in SQL here, with the same semantics of
+# `__process_context_types_filtering`: the distinct context types of a session have to be exactly `context_types`
+def __daily_sessions_query(session_length, context_types, hour_start, hour_end):
+    context_having = ""
+    if context_types:
+        context_list = ", ".join("'{0}'".format(x) for x in context_types)
+        context_having = " AND COUNT(DISTINCT context_type) == {0} AND SUM(context_type NOT IN ({1})) == 0".format(len(context_types), context_list)
+
+    return """
+        SELECT session_id, ROUND(AVG(hour_of_day), 0) AS hour_of_day
+        FROM sessions
+        WHERE session_length == {0}
+        GROUP BY session_id
+        HAVING ROUND(AVG(hour_of_day), 0) BETWEEN {1} AND {2}{3}
+        ORDER BY session_id
+        """.format(session_length, hour_start, hour_end, context_having)
+
+# lightweight first pass of sampling: sessions are selected here, and only the selected ones are read afterwards
+def __gather_daily_sessions(db, session_length, context_types, hour_start, hour_end):
+    return pd.read_sql(__daily_sessions_query(session_length, context_types, hour_start, hour_end), con=db)
+
+# number of sessions of a day for each hour. Only the counts are returned by SQLite, not the sessions themselves
+def __count_daily_sessions(db, session_length, context_types, hour_start, hour_end):
+    return pd.read_sql(
+        """
+        SELECT hour_of_day, COUNT(*) AS sessions
+        FROM({0})
+        GROUP BY hour_of_day
+        """.format(__daily_sessions_query(session_length, context_types, hour_start, hour_end)),
+        con=db
+    )
+
+# stratified sampling of the sessions of a day. The day is always a stratum (the caller works one day at a time), and
+# for time-of-day conditions each hour is a stratum as well. Either a fraction of each stratum (`sample_frac`) or
+# an exact number of sessions per stratum (`quotas`, by hour or by None if not stratified by hour) is sampled.
+# The random state depends on both seed and day, so that the same seed always selects the same sessions regardless
+# of which other days are part of the experiment
+def __sample_sessions(day, sessions, day_time, seed, sample_frac=None, quotas=None):
+    if sessions.shape[0] == 0:
+        return sessions["session_id"]
+
+    day_name = os.path.splitext(os.path.basename(day))[0]
+    random_state = np.random.RandomState([seed, zlib.crc32(day_name.encode())])
+
+    if __stratified_by_hour(day_time):
+        strata = sessions.groupby("hour_of_day")
+    else:
+        strata = [(None, sessions)]
+
+    sampled = []
+    for stratum, stratum_sessions in strata:
+        if quotas is None:
+            sampled.append(stratum_sessions.sample(frac=sample_frac, random_state=random_state))
+        else:
+            sampled.append(stratum_sessions.sample(n=quotas.get(stratum, 0), random_state=random_state))
+
+    return pd.concat(sampled)["session_id"]
+
+def __gather_daily_sampled_dataframe(day, session_length, context_types, day_time, seed, sample_frac=None, quotas=None):
+    # get range of hours
+    hour_start, hour_end = __hour_range(day_time)
+
+    # connect to db
+    db = __connect_read_only(day)
+
+    with db.connect() as con:
+        # first pass: select which sessions are part of the sample
+        sessions = __gather_daily_sessions(con, session_length, context_types, hour_start, hour_end)
+        session_ids = __sample_sessions(day, sessions, day_time, seed, sample_frac=sample_frac, quotas=quotas)
+
+        # second pass: read listening patterns of sampled sessions only. Ids are kept in a temporary table
+        # (private to this connection), so the day database itself is never modified
+        con.execute(text("CREATE TEMP TABLE sampled_sessions (session_id TEXT PRIMARY KEY)"))
+        if len(session_ids) > 0:
+            con.execute(text("INSERT INTO sampled_sessions VALUES (:session_id)"), [{"session_id": x} for x in session_ids])
+
+        dataframe = pd.read_sql(
+            """
+            SELECT GROUP_CONCAT(listening_pattern) AS listening_pattern
+            FROM(
+                SELECT sessions.session_id, listening_pattern
+                FROM sessions
+                JOIN sampled_sessions ON sessions.session_id == sampled_sessions.session_id
+                WHERE session_length == {0}
+                ORDER BY sessions.session_id, session_position
+            )
+            GROUP BY session_id
+            """.format(session_length),
+            con=con
+        )
+
+    # close connection
+    db.dispose()
+
+    # process dataframe to correct structure
+    dataframe = __split_listening_pattern_in_dataframe(dataframe)
+
+    return dataframe
+
+# size of every stratum of the population, as {(day, hour): sessions}. Hour is None if not stratified by hour
+def __count_strata(days, session_length, context_types, day_time):
+    hour_start, hour_end = __hour_range(day_time)
+
+    strata_sizes = {}
+    for day in days:
+        print("Counting: {0}".format(day))
+        db = __connect_read_only(day)
+        with db.connect() as con:
+            counts = __count_daily_sessions(con, session_length, context_types, hour_start, hour_end)
+        db.dispose()
+
+        for hour, sessions in zip(counts["hour_of_day"], counts["sessions"]):
+            stratum = (day, hour if __stratified_by_hour(day_time) else None)
+            strata_sizes[stratum] = strata_sizes.get(stratum, 0) + int(sessions)
+
+    return strata_sizes
+
+# split `sample_n` among strata proportionally to their size. Rounding remainders go to the strata with the largest
+# fractional parts, so that quotas always sum to exactly `sample_n` (or to the population, if smaller)
+def __allocate_sample(strata_sizes, sample_n):
+    population = sum(strata_sizes.values())
+    if sample_n >= population:
+        return dict(strata_sizes)
+
+    strata = sorted(strata_sizes, key=lambda x: (x[0], -1 if x[1] is None else x[1]))
+    exact = {x: sample_n * strata_sizes[x] / population for x in strata}
+    quotas = {x: int(np.floor(exact[x])) for x in strata}
+
+    remaining = sample_n - sum(quotas.values())
+    for x in sorted(strata, key=lambda x: exact[x] - quotas[x], reverse=True)[:remaining]:
+        quotas[x] += 1
+
+    return quotas
+
+def __days_and_day_time(_type):
+    if _type == "weekday":
+        return __get_weekdays_weekends_files()[0], "all"
+    elif _type == "weekend":
+        return __get_weekdays_weekends_files()[1], "all"
+    elif _type in ("all", "morning", "afternoon", "evening", "night"):
+        return __get_all_files(), _type
+    else:
+        raise Exception("Unrecognised experiment type '{0}'".format(_type))
+
+# day databases used by an experiment type
+def get_days(_type):
+    return __days_and_day_time(_type)[0]
+
 # this method returns a single dataframe which is concatenation of all dataframes in which experimental conditions are applied.
 # For example, it returns all mornings in a single dataframe
-def __gather_single_dataframe(days, session_length, context_types, day_time):
+def __gather_single_dataframe(days, session_length, context_types, day_time, sample_frac=None, quotas=None, seed=0):
     dataframe = None
     for day in days:
         print("Reading: {0}".format(day))
 
-        # get full data for that day
-        df = __gather_daily_dataframe(day, session_length, context_types, day_time=day_time)
+        # get full (or sampled) data for that day
+        if quotas is not None:
+            day_quotas = {hour: n for (_day, hour), n in quotas.items() if _day == day}
+            df = __gather_daily_sampled_dataframe(day, session_length, context_types, day_time, seed, quotas=day_quotas)
+        elif sample_frac is not None:
+            df = __gather_daily_sampled_dataframe(day, session_length, context_types, day_time, seed, sample_frac=sample_frac)
+        else:
+            df = __gather_daily_dataframe(day, session_length, context_types, day_time=day_time)
 
         # update dataframe with new sample. Set if first time, otherwise append to existing dataframe
         if dataframe is None:
@@ -137,20 +310,38 @@ def __gather_single_dataframe(days, session_length, context_types, day_time):
 
     return dataframe
 
-def generate_dataframe(_type, session_length, context_types, dataframe_path):
+# generator over the full population of an experiment, one day at a time. It allows to process (e.g. label with a model
+# fitted on a sample) every session without keeping them all in memory. Daily dataframes are indexed by session_id
+def iterate_daily_dataframes(_type, session_length, context_types):
+    days, day_time = __days_and_day_time(_type)
+    for day in days:
+        print("Reading: {0}".format(day))
+        yield day, __gather_daily_dataframe(day, session_length, context_types, day_time=day_time, with_session_ids=True)
+
+# `sample_frac` (fraction of sessions, 0-1) and `sample_n` (exact number of sessions) are mutually exclusive. If
+# neither is given, the full population is collected. Sampling is stratified by day (and hour for time-of-day types).
+# It returns the dataframe, and the population size if it was counted (i.e. with `sample_n`), None otherwise
+def generate_dataframe(_type, session_length, context_types, dataframe_path, sample_frac=None, sample_n=None, seed=0):
+    days, day_time = __days_and_day_time(_type)
+
+    # a sample size is split among strata proportionally to their size (counted beforehand)
+    population = None
+    quotas = None
+    if sample_n is not None:
+        strata_sizes = __count_strata(days, session_length, context_types, day_time)
+        population = sum(strata_sizes.values())
+        quotas = __allocate_sample(strata_sizes, sample_n)
+        print("... population size: {0}, sample size: {1}".format(population, sum(quotas.values())))
+
     # get dataframe based on experimental conditions
-    if _type == "all":
-        dataframe = __gather_single_dataframe(__get_all_files(), session_length, context_types, _type)
-    if _type == "weekday":
-        days = __get_weekdays_weekends_files()[0]
-        dataframe = __gather_single_dataframe(days, session_length, context_types, "all")
-    elif _type == "weekend":
-        days = __get_weekdays_weekends_files()[1]
-        dataframe = __gather_single_dataframe(days, session_length, context_types, "all")
-    elif (_type == "morning") or (_type == "afternoon") or (_type == "evening") or (_type == "night"):
-        dataframe = __gather_single_dataframe(__get_all_files(), session_length, context_types, _type)
-    
+    dataframe = __gather_single_dataframe(days, session_length, context_types, day_time, sample_frac=sample_frac, quotas=quotas, seed=seed)
+
+    # e.g. a small `sample_frac` rounds every stratum down to 0 sessions
+    if (dataframe is None) or (dataframe.shape[0] == 0):
+        raise Exception("No sessions collected for type '{0}' and session length {1} (sample_frac: {2}, sample_n: {3}). Use a larger sample".format(
+            _type, session_length, sample_frac, sample_n))
+
     # save dataframe to file
-    dataframe.to_parquet(dataframe_path)
+    experiment_io.atomic_to_parquet(dataframe, dataframe_path)
 
-    return dataframe
+    return dataframe, population
@@ -0,0 +1,127 @@
+import os
+import glob
+import json
+import fcntl
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+from contextlib import contextmanager
+
+# folder for session matrices shared (memory-mapped) by concurrent experiments
+SHARED_DATA_PATH = "data/shared"
+
+# exclusive lock on `lock_path`, held for the duration of the `with` block. Locks are released by the OS if the process
+# dies, so a left-over lock file never blocks future runs
+@contextmanager
+def file_lock(lock_path):
+    with open(lock_path, "a") as fp:
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Waiting for lock: {0}".format(lock_path))
+            fcntl.flock(fp, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+# permissions given by `open` to new files. Temporary files are created readable by their owner only, so they are
+# given these permissions before being renamed
+def __default_file_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+# yields a temporary path in the same folder as `path`, which is renamed to `path` once the `with` block succeeds.
+# Readers therefore see either the previous file or the complete new one, never a partially written file
+@contextmanager
+def atomic_path(path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".{0}.".format(os.path.basename(path)), suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, __default_file_mode())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def atomic_pickle_dump(obj, path):
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "wb") as fp:
+            pickle.dump(obj, fp)
+
+def atomic_json_dump(obj, path):
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "w") as fp:
+            json.dump(obj, fp)
+
+def atomic_to_parquet(dataframe, path):
+    with atomic_path(path) as tmp_path:
+        dataframe.to_parquet(tmp_path)
+
+# path of the shared session matrix for a set of experimental conditions. Experiments with the same conditions (and
+# sampling) on the same day databases use the same matrix, whatever their name. Day databases are identified by
+# path, size and modification time, so that a matrix is never reused after databases are added or re-created
+def shared_matrix_path(_type, session_length, context_types, sample_frac, sample_n, seed, days):
+    days_fingerprint = [(day, os.path.getsize(day), os.path.getmtime(day)) for day in sorted(days)]
+    key = json.dumps([_type, session_length, context_types, sample_frac, sample_n, seed, days_fingerprint])
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return "{0}/{1}_{2}_{3}.npy".format(SHARED_DATA_PATH, _type, session_length, digest)
+
+# `info` (e.g. population size) is saved next to the matrix, before it, so that a complete matrix always has its info
+def save_shared_matrix(dataframe, path, info):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_json_dump(info, path + ".json")
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "wb") as fp:
+            np.save(fp, dataframe.to_numpy(dtype="float32"))
+
+# read-only, memory-mapped dataframe of a shared session matrix. Pages are shared through the OS page cache, so N
+# concurrent experiments on the same conditions hold a single copy of the sessions in memory
+def load_shared_matrix(path):
+    matrix = np.load(path, mmap_mode="r")
+
+    # same column names as generated by `experiment_data_collection`
+    columns = ["pos{0}".format(i) for i in range(1, matrix.shape[1] + 1)]
+
+    return pd.DataFrame(matrix, columns=columns, copy=False)
+
+def load_shared_matrix_info(path):
+    with open(path + ".json", "r") as fp:
+        return json.load(fp)
+
+# shared matrices referred to (via SHARED_MATRIX in conf.json) by experiments in `results_path`
+def __referenced_shared_matrices(results_path):
+    referenced = set()
+    for conf_path in glob.glob("{0}/*/conf.json".format(results_path)):
+        with open(conf_path, "r") as fp:
+            shared_path = json.load(fp).get("SHARED_MATRIX")
+        if shared_path is not None:
+            referenced.add(os.path.normpath(shared_path))
+    return referenced
+
+# delete shared matrices (and their info) that no experiment refers to. Each matrix is checked while holding its lock,
+# and experiments record the matrix they use while holding it, so a matrix in use is never deleted. Lock files are
+# kept (they are empty), since deleting them would break the locking of runs that already opened them
+def prune_shared_matrices(results_path="results"):
+    removed = []
+    for shared_path in sorted(glob.glob("{0}/*.npy".format(SHARED_DATA_PATH))):
+        with file_lock(shared_path + ".lock"):
+            if os.path.normpath(shared_path) in __referenced_shared_matrices(results_path):
+                continue
+            os.remove(shared_path)
+            if os.path.isfile(shared_path + ".json"):
+                os.remove(shared_path + ".json")
+        removed.append(shared_path)
+
+    return removed
+
+if __name__ == "__main__":
+    print("Pruning shared matrices not used by any experiment")
+    for shared_path in prune_shared_matrices():
+        print("Deleted: {0}".format(shared_path))